@@ -26,9 +26,11 @@ Help:
 
 from docopt import docopt
 
+from requests.adapters import HTTPAdapter
 from stormpath.client import Client
 
 from . import __version__ as VERSION
+from .constants import MAX_WORKERS
 from .migrators import TenantMigrator
 
 
@@ -51,6 +53,20 @@ def validate_credentials(src, dst):
             raise ValueError('Invalid credentials specified. Use <id:secret> format.')
 
 
+def configure_connection_pool(client, size=MAX_WORKERS):
+    """
+    Size a Stormpath Client's HTTP connection pool so that every migrator
+    thread can reuse a pooled connection, rather than opening a new one.
+
+    :param obj client: A Stormpath Client.
+    :param int size: The number of connections to keep open.
+    """
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session = client.data_store.executor.session
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
 def create_clients(src, dst, src_url, dst_url):
     """
     Create our local Stormpath Client objects used for the migration.
@@ -66,11 +82,16 @@ def create_clients(src, dst, src_url, dst_url):
     src_id, src_secret = src.split(':')
     dst_id, dst_secret = dst.split(':')
 
-    return (
+    clients = (
         Client(id=src_id, secret=src_secret, base_url=src_url),
         Client(id=dst_id, secret=dst_secret, base_url=dst_url),
     )
 
+    for client in clients:
+        configure_connection_pool(client)
+
+    return clients
+
 
 def main():
     """Main CLI entrypoint."""
@@ -12,3 +12,6 @@ STORMPATH_PROVIDER_ID = 'stormpath'
 
 # SAML ID.
 SAML_PROVIDER_ID = 'saml'
+
+# The maximum number of migrators (and Stormpath API requests) to run at once.
+MAX_WORKERS = 16
@@ -4,9 +4,9 @@ Stormpath resource type.
 """
 
 
-from .base import BaseMigrator
+from .base import BaseMigrator, migrate_all
 from .account import AccountMigrator
-from .account_store_mapping import ApplicationAccountStoreMappingMigrator, OrganizationAccountStoreMappingMigrator
+from .account_store_mapping import ApplicationAccountStoreMappingMigrator, OrganizationAccountStoreMappingMigrator, index_account_store_mappings, migrate_account_store_mappings
 from .application import ApplicationMigrator
 from .directory import DirectoryMigrator
 from .directory_workflow import DirectoryWorkflowMigrator
@@ -1,122 +1,402 @@
 """Our ApplicationAccountStoreMapping Migrator."""
 
 
+from collections import OrderedDict
+from random import uniform
+from threading import Lock
+from time import sleep, time
+
 from stormpath.error import Error as StormpathError
 
-from . import BaseMigrator
+from . import BaseMigrator, migrate_all
 from .. import logger
+from ..constants import MAX_WORKERS
+
+
+# How long (in seconds) destination Tenant / AccountStore lookups are cached.
+CACHE_TTL = 3600
+
+# The maximum number of cached lookups.
+CACHE_SIZE = 4096
+
+_cache = {}
+_cache_lock = Lock()
 
 
-class ApplicationAccountStoreMappingMigrator(BaseMigrator):
+def _retry(fn, desc, max_retries=5, base=1.0, cap=30.0):
     """
-    This class manages a migration from one Stormpath ApplicationAccountStoreMapping to another.
+    Call `fn` until it succeeds, backing off exponentially (with jitter)
+    between failed attempts.
+
+    Client errors (HTTP 4xx, except 429) won't go away by retrying, so they're
+    raised immediately.  Everything else is retried up to `max_retries` times
+    before the last error is raised.
+
+    :param func fn: A callable taking no arguments.
+    :param str desc: A short description of the operation, used for logging.
+    :param int max_retries: The maximum number of retries.
+    :param float base: The initial delay (in seconds).
+    :param float cap: The maximum delay (in seconds), before jitter.
+    :returns: Whatever `fn` returns.
+    :raises: StormpathError if all attempts fail.
     """
-    RESOURCE = 'account_store_mapping'
-    COLLECTION_RESOURCE = 'account_store_mappings'
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except StormpathError as err:
+            status = getattr(err, 'status', None) or 0
+            if 400 <= status < 500 and status != 429:
+                logger.error('Failed to {} ({})'.format(desc, err))
+                raise
+
+            if attempt >= max_retries:
+                logger.error('Failed to {} after {} retries ({})'.format(desc, max_retries, err))
+                raise
+
+            delay = min(cap, base * 2 ** attempt) * (1 + uniform(0, 0.5))
+            logger.error('Failed to {} ({}).  Retrying in {:.1f}s.'.format(desc, err, delay))
+            sleep(delay)
+            attempt += 1
+
+
+def _memoize(key, fn):
+    """
+    Return the cached result for `key`, calling `fn` to compute it if it's
+    missing or older than CACHE_TTL.  None results aren't cached, since the
+    resource may be created later on in the migration.
 
-    def __init__(self, destination_application, source_account_store_mapping):
-        self.destination_application = destination_application
-        self.source_account_store_mapping = source_account_store_mapping
+    :param tuple key: A hashable cache key (built from hrefs / names).
+    :param func fn: A callable taking no arguments.
+    :returns: Whatever `fn` returns.
+    """
+    now = time()
+    with _cache_lock:
+        entry = _cache.get(key)
 
-    def get_destination_account_store(self):
+    if entry and now - entry[0] < CACHE_TTL:
+        return entry[1]
+
+    value = fn()
+    if value is not None:
+        _remember(key, value, now)
+
+    return value
+
+
+def _remember(key, value, now=None):
+    """
+    Store `value` in the cache under `key`.  The whole cache is cleared once
+    it reaches CACHE_SIZE entries.
+
+    :param tuple key: A hashable cache key (built from hrefs / names).
+    :param object value: The value to cache.
+    :param float now: (optional) The time the value was fetched at.
+    """
+    with _cache_lock:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[key] = (time() if now is None else now, value)
+
+
+def _get_tenant(resource):
+    """
+    Retrieve (and cache) the Tenant that owns `resource`.
+
+    The cache is keyed by the Tenant's href (which the SDK knows from the
+    link, without a fetch), so every Application / Organization in a Tenant
+    shares one lookup.
+
+    :param object resource: An Application or Organization.
+    :rtype: object
+    :returns: The Tenant.
+    """
+    tenant = resource.tenant
+    return _memoize(('tenant', tenant.href), lambda: _retry(
+        lambda: tenant.refresh() or tenant,
+        'fetch destination Tenant'
+    ))
+
+
+def _find_destination_store(tenant, collection, name):
+    """
+    Retrieve (and cache) the AccountStore named `name` from one of the
+    Tenant's collections.
+
+    :param object tenant: The destination Tenant.
+    :param str collection: The Tenant collection to search, eg: 'directories'.
+    :param str name: The AccountStore name.
+    :rtype: object (or None)
+    :returns: The AccountStore, or None.
+    """
+    def search():
+        matches = getattr(tenant, collection).search({'name': name})
+        return matches[0] if len(matches) > 0 else None
+
+    return _memoize((tenant.href, collection, name), lambda: _retry(
+        search,
+        'fetch destination {}: {}'.format(collection, name.encode('utf-8'))
+    ))
+
+
+def _get_collection(account_store):
+    """
+    Return the name of the Tenant collection an AccountStore lives in.
+
+    :param object account_store: A Directory, Organization, or Group.
+    :rtype: str
+    :returns: The collection name, eg: 'directories'.
+    """
+    klass = account_store.__class__.__name__
+    return 'directories' if klass == 'Directory' else klass.lower() + 's'
+
+
+def _prefetch_destination_stores(tenant, specs):
+    """
+    Fetch many destination AccountStores at once, walking each Tenant
+    collection a single time rather than searching it once per name.
+
+    Names are matched exactly, which may be stricter than a search, so
+    AccountStores which aren't found here are searched for later on.  If
+    several AccountStores share a name, the first one wins (as it does for a
+    search).  Every AccountStore found is also stored in the lookup cache.
+
+    :param object tenant: The destination Tenant.
+    :param list specs: A list of `(collection, name)` tuples.
+    :rtype: dict
+    :returns: A dict of `{(collection, name): account_store}`.  AccountStores
+        which weren't found are left out.
+    """
+    wanted = {}
+    for collection, name in specs:
+        wanted.setdefault(collection, set()).add(name)
+
+    index = {}
+    for collection, names in wanted.items():
+        def walk():
+            found = {}
+            for store in getattr(tenant, collection):
+                if store.name in names and (collection, store.name) not in found:
+                    found[(collection, store.name)] = store
+
+            return found
+
+        found = _retry(walk, 'fetch destination {}'.format(collection))
+        for key, store in found.items():
+            _remember((tenant.href,) + key, store)
+
+        index.update(found)
+
+    return index
+
+
+def migrate_account_store_mappings(migrators, max_workers=MAX_WORKERS):
+    """
+    Migrate a batch of AccountStoreMappings which share a destination
+    Tenant.
+
+    The source AccountStores are loaded concurrently, and then all of the
+    destination AccountStores are prefetched once, before any of the
+    migrators run.  Each migrator does a dict lookup instead of its own
+    search.  Migrators whose AccountStore couldn't be prefetched fall back to
+    searching.
+
+    Each Application / Organization's mappings are migrated one at a time, in
+    `list_index` order, while different parents are migrated concurrently.
+
+    :param list migrators: A list of ApplicationAccountStoreMappingMigrator
+        and / or OrganizationAccountStoreMappingMigrator objects.
+    :param int max_workers: The maximum number of parents to migrate at once.
+    :rtype: list
+    :returns: A list of the migrated Mappings (or None, for each mapping
+        which was skipped), in the same order as `migrators`.
+    """
+    if not migrators:
+        return []
+
+    loaders = [_SourceAccountStoreLoader(migrator) for migrator in migrators]
+    specs = [spec for spec in migrate_all(loaders, max_workers=max_workers) if spec]
+
+    try:
+        tenant = migrators[0].get_destination_tenant()
+        index = migrators[0].prefetch_destination_stores(tenant, specs)
+    except StormpathError:
+        index = None
+
+    parents = OrderedDict()
+    for migrator in migrators:
+        migrator.destination_store_index = index
+        parents.setdefault(getattr(migrator, migrator._PARENT_ATTR).href, []).append(migrator)
+
+    batches = [_AccountStoreMappingBatch(batch) for batch in parents.values()]
+
+    results = {}
+    for batch, batch_results in zip(batches, migrate_all(batches, max_workers=max_workers)):
+        for migrator, result in zip(batch.migrators, batch_results or []):
+            results[id(migrator)] = result
+
+    return [results.get(id(migrator)) for migrator in migrators]
+
+
+class _SourceAccountStoreLoader(object):
+    """
+    Loads a migrator's source AccountStore (so `migrate()` won't need to) and
+    returns its prefetch spec.  Run through `migrate_all()`.
+    """
+    def __init__(self, migrator):
+        self.migrator = migrator
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.migrator.source_account_store_mapping.account_store.href)
+
+    def migrate(self):
         """
-        Retrieve the destination AccountStore (either Directory, Organization,
-        or Group).
+        Load the source AccountStore.
 
-        :rtype: object (or None)
-        :returns: The AccountStore, or None.
+        :rtype: tuple
+        :returns: A `(collection, name)` tuple.
         """
-        tenant = self.destination_tenant
-        sas = self.source_account_store
+        sas = self.migrator.get_source_account_store()
+        self.migrator.source_account_store = sas
+        return (_get_collection(sas), sas.name)
 
-        klass = sas.__class__.__name__
-        collection = 'directories' if klass == 'Directory' else klass.lower() + 's'
 
-        while True:
-            try:
-                matches = getattr(tenant, collection).search({'name': sas.name})
-                return matches[0] if len(matches) > 0 else None
-            except StormpathError as err:
-                logger.error('Failed to fetch destination {}: {} ({})'.format(klass, sas.name.encode('utf-8'), err))
+class _AccountStoreMappingBatch(object):
+    """
+    Migrates the AccountStoreMappings of a single Application / Organization.
 
-    def copy_mapping(self):
+    Stormpath treats `list_index` as an insert position (shifting the
+    existing mappings down), so the mappings are created one at a time, in
+    `list_index` order, to keep the AccountStore priority intact.
+
+    The parent's existing mappings are indexed lazily, by whichever migrator
+    needs them first, and that index is shared with the rest of the batch.
+    """
+    def __init__(self, migrators):
+        self.migrators = sorted(migrators, key=lambda m: m.source_account_store_mapping.list_index)
+
+    def __repr__(self):
+        migrator = self.migrators[0]
+        parent = getattr(migrator, migrator._PARENT_ATTR)
+        return '%s(%s: %s, %s)' % (self.__class__.__name__, parent.__class__.__name__, parent.name.encode('utf-8'), parent.href)
+
+    def migrate(self):
         """
-        Copy the source Mapping over into the destination Tenant.
+        Run each migrator in turn.  A migrator which raises an error is logged
+        and treated as skipped, so the rest of the batch still runs.
 
-        :rtype: object (or None)
-        :returns: The copied Mapping, or None.
+        :rtype: list
+        :returns: A list of each migrator's result (or None, for each
+            migrator which failed), in `list_index` order.
         """
-        da = self.destination_application
-        das = self.destination_account_store
-        sasm = self.source_account_store_mapping
+        results = []
+        existing_mappings = None
 
-        # First, we'll check to see if this mapping already exists.  If it does,
-        # we'll return immediately as there's nothing to do here.
-        for mapping in da.account_store_mappings:
-            if mapping.account_store.href == das.href and mapping.application.href == da.href:
-                return mapping
+        for migrator in self.migrators:
+            if migrator._existing_mappings_by_store is None:
+                migrator._existing_mappings_by_store = existing_mappings
 
-        while True:
             try:
-                return da.account_store_mappings.create({
-                    'account_store': das,
-                    'application': da,
-                    'list_index': sasm.list_index,
-                    'is_default_account_store': sasm.is_default_account_store,
-                    'is_default_group_store': sasm.is_default_group_store,
-                })
-            except StormpathError as err:
-                logger.error('Failed to copy AccountStoreMapping from Application: {} to {} {} ({})'.format(
-                    da.name.encode('utf-8'),
-                    das.__class__.__name__,
-                    das.name.encode('utf-8'),
+                results.append(migrator.migrate())
+            except Exception as err:
+                logger.error('Failed to migrate AccountStoreMapping: {} into {} ({})'.format(
+                    migrator.source_account_store_mapping.href,
+                    self,
                     err
                 ))
+                results.append(None)
 
-    def migrate(self):
-        """
-        Migrates one Mapping to another Tenant =)  Won't stop until the
-        migration is complete.
+            existing_mappings = migrator._existing_mappings_by_store
 
-        :rtype: object (or None)
-        :returns: The migrated Mapping, or None.
-        """
-        self.destination_tenant = self.destination_application.tenant
-        self.source_account_store = self.source_account_store_mapping.account_store
-        self.destination_account_store = self.get_destination_account_store()
+        return results
 
-        if not self.destination_account_store:
-            logger.warning('Skipping creation of AccountStoreMapping from Application: {} to {} {} (The destination AccountStore does not exist)'.format(
-                self.destination_application.name.encode('utf-8'),
-                self.source_account_store.__class__.__name__,
-                self.source_account_store.name.encode('utf-8')
-            ))
-            return
 
-        mapping = self.copy_mapping()
-        logger.info('Successfully copied source AccountStoreMapping from Application: {} to {} {}.'.format(
-            self.destination_application.name.encode('utf-8'),
-            self.destination_account_store.__class__.__name__,
-            self.destination_account_store.name.encode('utf-8')
-        ))
+def index_account_store_mappings(mappings):
+    """
+    Index a collection of AccountStoreMappings by AccountStore href.
 
-        return mapping
+    This walks the collection once, so callers migrating many mappings into
+    the same Application / Organization can share the result instead of
+    re-scanning the collection for every mapping.
+
+    :param object mappings: An AccountStoreMapping collection.
+    :rtype: dict
+    :returns: A dict of `{account_store_href: mapping}`.
+    """
+    return _retry(
+        lambda: dict((m.account_store.href, m) for m in mappings),
+        'fetch existing AccountStoreMappings'
+    )
 
 
-class OrganizationAccountStoreMappingMigrator(BaseMigrator):
+class _BaseAccountStoreMappingMigrator(BaseMigrator):
     """
-    This class manages a migration from one Stormpath OrganizationAccountStoreMapping to another.
+    This class holds the migration logic shared by the Application and
+    Organization AccountStoreMapping migrators.
+
+    Subclasses set `_PARENT_ATTR` (the attribute holding the destination
+    Application / Organization), `_PARENT_KEY` (the parent's key in a
+    Mapping), and implement `_create_endpoint()`.
     """
     RESOURCE = 'account_store_mapping'
     COLLECTION_RESOURCE = 'account_store_mappings'
 
-    def __init__(self, destination_organization, source_account_store_mapping):
-        self.destination_organization = destination_organization
+    _PARENT_ATTR = None
+    _PARENT_KEY = None
+
+    def __init__(self, source_account_store_mapping, existing_mappings=None):
         self.source_account_store_mapping = source_account_store_mapping
+        self._existing_mappings_by_store = existing_mappings
+        self.destination_store_index = None
+        self.source_account_store = None
+
+    def _create_endpoint(self, client):
+        """
+        Return the Client collection that new Mappings are created in.
+
+        :param object client: The destination Client.
+        :rtype: object
+        :returns: A Mapping collection.
+        """
+        raise NotImplementedError('%s._create_endpoint() must be defined.' % self.__class__.__name__)
+
+    @classmethod
+    def prefetch_destination_stores(cls, tenant, specs):
+        """
+        Fetch the destination AccountStores for a batch of migrators, to be
+        passed into `migrate()` as the `destination_store_index`.
+
+        :param object tenant: The destination Tenant.
+        :param list specs: A list of `(collection, name)` tuples.
+        :rtype: dict
+        :returns: A dict of `{(collection, name): account_store}`.
+        """
+        return _prefetch_destination_stores(tenant, specs)
+
+    def get_source_account_store(self):
+        """
+        Retrieve the source AccountStore (either Directory, Organization,
+        or Group).
+
+        :rtype: object
+        :returns: The source AccountStore.
+        """
+        sasm = self.source_account_store_mapping
+        return _retry(lambda: sasm.account_store.refresh() or sasm.account_store, 'fetch source AccountStore')
+
+    def get_destination_tenant(self):
+        """
+        Retrieve the destination Tenant.
+
+        :rtype: object
+        :returns: The destination Tenant.
+        """
+        return _get_tenant(getattr(self, self._PARENT_ATTR))
 
     def get_destination_account_store(self):
         """
-        Retrieve the destination AccountStore (either Directory or Group).
+        Retrieve the destination AccountStore (either Directory, Organization,
+        or Group).
 
         :rtype: object (or None)
         :returns: The AccountStore, or None.
@@ -124,15 +404,29 @@ class OrganizationAccountStoreMappingMigrator(BaseMigrator):
         tenant = self.destination_tenant
         sas = self.source_account_store
 
-        klass = sas.__class__.__name__
-        collection = 'directories' if klass == 'Directory' else klass.lower() + 's'
+        # AccountStores missing from the index might still exist (the
+        # prefetch matches names more strictly than a search), so we'll search
+        # for those instead.
+        collection = _get_collection(sas)
+        store = (self.destination_store_index or {}).get((collection, sas.name))
+        if store is not None:
+            return store
 
-        while True:
-            try:
-                matches = getattr(tenant, collection).search({'name': sas.name})
-                return matches[0] if len(matches) > 0 else None
-            except StormpathError as err:
-                logger.error('Failed to fetch destination {}: {} ({})'.format(klass, sas.name.encode('utf-8'), err))
+        return _find_destination_store(tenant, collection, sas.name)
+
+    def get_existing_mappings(self):
+        """
+        Retrieve the destination parent's existing AccountStoreMappings,
+        indexed by AccountStore href.  The index is built once and cached (or
+        shared, if one was passed in).
+
+        :rtype: dict
+        :returns: A dict of `{account_store_href: mapping}`.
+        """
+        if self._existing_mappings_by_store is None:
+            self._existing_mappings_by_store = index_account_store_mappings(getattr(self, self._PARENT_ATTR).account_store_mappings)
+
+        return self._existing_mappings_by_store
 
     def copy_mapping(self):
         """
@@ -141,58 +435,134 @@ class OrganizationAccountStoreMappingMigrator(BaseMigrator):
         :rtype: object (or None)
         :returns: The copied Mapping, or None.
         """
-        do = self.destination_organization
+        dp = getattr(self, self._PARENT_ATTR)
         das = self.destination_account_store
         sasm = self.source_account_store_mapping
 
         # First, we'll check to see if this mapping already exists.  If it does,
         # we'll return immediately as there's nothing to do here.
-        for mapping in do.account_store_mappings:
-            if mapping.account_store.href == das.href and mapping.organization.href == do.href:
-                return mapping
+        existing_mappings = self.get_existing_mappings()
+        existing = existing_mappings.get(das.href)
+        if existing and getattr(existing, self._PARENT_KEY).href == dp.href:
+            return existing
+
+        endpoint = self._create_endpoint(dp.account_store_mappings._client)
+        try:
+            mapping = _retry(lambda: endpoint.create({
+                'account_store': das,
+                self._PARENT_KEY: dp,
+                'list_index': sasm.list_index,
+                'is_default_account_store': sasm.is_default_account_store,
+                'is_default_group_store': sasm.is_default_group_store,
+            }), 'copy AccountStoreMapping from {}: {} to {} {}'.format(
+                dp.__class__.__name__,
+                dp.name.encode('utf-8'),
+                das.__class__.__name__,
+                das.name.encode('utf-8')
+            ))
+        except StormpathError as err:
+            # If a retried create conflicts, an earlier attempt most likely
+            # succeeded and only its response was lost.  We'll re-index the
+            # existing mappings and return that one instead.
+            if getattr(err, 'status', None) != 409:
+                raise err
 
-        while True:
-            try:
-                return do.account_store_mappings._client.organization_account_store_mappings.create({
-                    'account_store': das,
-                    'organization': do,
-                    'list_index': sasm.list_index,
-                    'is_default_account_store': sasm.is_default_account_store,
-                    'is_default_group_store': sasm.is_default_group_store,
-                })
-            except StormpathError as err:
-                logger.error('Failed to copy AccountStoreMapping from Organization: {} to {} {} ({})'.format(
-                    do.name.encode('utf-8'),
-                    das.__class__.__name__,
-                    das.name.encode('utf-8'),
-                    err
-                ))
+            existing_mappings.update(index_account_store_mappings(dp.account_store_mappings))
+            mapping = existing_mappings.get(das.href)
+            if mapping is None:
+                raise err
 
-    def migrate(self):
+            return mapping
+
+        existing_mappings[das.href] = mapping
+        return mapping
+
+    def migrate(self, destination_store_index=None):
         """
-        Migrates one Mapping to another Tenant =)  Won't stop until the
-        migration is complete.
+        Migrates one Mapping to another Tenant =)  Transient errors are
+        retried with backoff; if the migration still fails, it's skipped.
 
+        :param dict destination_store_index: (optional) The prefetched
+            destination AccountStores, as returned by
+            `prefetch_destination_stores()`.
         :rtype: object (or None)
         :returns: The migrated Mapping, or None.
         """
-        self.destination_tenant = self.destination_organization.tenant
-        self.source_account_store = self.source_account_store_mapping.account_store
-        self.destination_account_store = self.get_destination_account_store()
+        dp = getattr(self, self._PARENT_ATTR)
+
+        if destination_store_index is not None:
+            self.destination_store_index = destination_store_index
+
+        try:
+            self.destination_tenant = self.get_destination_tenant()
+            if self.source_account_store is None:
+                self.source_account_store = self.get_source_account_store()
+            self.destination_account_store = self.get_destination_account_store()
+        except StormpathError as err:
+            logger.warning('Skipping creation of AccountStoreMapping from {}: {} to AccountStore {} (Unable to fetch the AccountStores: {})'.format(
+                dp.__class__.__name__,
+                dp.name.encode('utf-8'),
+                self.source_account_store_mapping.account_store.href,
+                err
+            ))
+            return
 
         if not self.destination_account_store:
-            logger.warning('Skipping creation of AccountStoreMapping from Organization: {} to {} {} (The destination AccountStore does not exist)'.format(
-                self.destination_organization.name.encode('utf-8'),
+            logger.warning('Skipping creation of AccountStoreMapping from {}: {} to {} {} (The destination AccountStore does not exist)'.format(
+                dp.__class__.__name__,
+                dp.name.encode('utf-8'),
                 self.source_account_store.__class__.__name__,
                 self.source_account_store.name.encode('utf-8')
             ))
             return
 
-        mapping = self.copy_mapping()
-        logger.info('Successfully copied source AccountStoreMapping from Organization: {} to {} {}.'.format(
-            self.destination_organization.name.encode('utf-8'),
+        try:
+            mapping = self.copy_mapping()
+        except StormpathError as err:
+            logger.warning('Skipping creation of AccountStoreMapping from {}: {} to {} {} (Unable to copy the AccountStoreMapping: {})'.format(
+                dp.__class__.__name__,
+                dp.name.encode('utf-8'),
+                self.destination_account_store.__class__.__name__,
+                self.destination_account_store.name.encode('utf-8'),
+                err
+            ))
+            return
+
+        logger.info('Successfully copied source AccountStoreMapping from {}: {} to {} {}.'.format(
+            dp.__class__.__name__,
+            dp.name.encode('utf-8'),
             self.destination_account_store.__class__.__name__,
             self.destination_account_store.name.encode('utf-8')
         ))
 
         return mapping
+
+
+class ApplicationAccountStoreMappingMigrator(_BaseAccountStoreMappingMigrator):
+    """
+    This class manages a migration from one Stormpath ApplicationAccountStoreMapping to another.
+    """
+    _PARENT_ATTR = 'destination_application'
+    _PARENT_KEY = 'application'
+
+    def __init__(self, destination_application, source_account_store_mapping, existing_mappings=None):
+        self.destination_application = destination_application
+        super(ApplicationAccountStoreMappingMigrator, self).__init__(source_account_store_mapping, existing_mappings)
+
+    def _create_endpoint(self, client):
+        return client.account_store_mappings
+
+
+class OrganizationAccountStoreMappingMigrator(_BaseAccountStoreMappingMigrator):
+    """
+    This class manages a migration from one Stormpath OrganizationAccountStoreMapping to another.
+    """
+    _PARENT_ATTR = 'destination_organization'
+    _PARENT_KEY = 'organization'
+
+    def __init__(self, destination_organization, source_account_store_mapping, existing_mappings=None):
+        self.destination_organization = destination_organization
+        super(OrganizationAccountStoreMappingMigrator, self).__init__(source_account_store_mapping, existing_mappings)
+
+    def _create_endpoint(self, client):
+        return client.organization_account_store_mappings
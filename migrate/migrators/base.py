@@ -1,6 +1,43 @@
 """Base Migrator class."""
 
 
+from multiprocessing.pool import ThreadPool
+
+from .. import logger
+from ..constants import MAX_WORKERS
+
+
+def migrate_all(migrators, max_workers=MAX_WORKERS):
+    """
+    Run many migrators concurrently.
+
+    Migrations spend almost all of their time waiting on the Stormpath API,
+    so they're run in a pool of threads.  A migrator which raises an error is
+    logged and treated as skipped.
+
+    :param list migrators: A list of migrator objects.
+    :param int max_workers: The maximum number of migrators to run at once.
+    :rtype: list
+    :returns: A list of each migrator's result (or None, for each migrator
+        which failed), in the same order as `migrators`.
+    """
+    def run(migrator):
+        try:
+            return migrator.migrate()
+        except Exception as err:
+            logger.error('Failed to run {} ({})'.format(migrator, err))
+
+    if not migrators:
+        return []
+
+    pool = ThreadPool(min(max_workers, len(migrators)))
+    try:
+        return pool.map(run, migrators)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class BaseMigrator(object):
     """"
     This class provides a template for all other migrators.
@@ -65,13 +65,18 @@ class TenantMigrator(BaseMigrator):
                 migrator = DirectoryWorkflowMigrator(destination_directory=destination_directory, source_directory=directory)
                 migrator.migrate()
 
+        # AccountStoreMappings are migrated last, all in one batch, so their
+        # destination AccountStores can be prefetched once for the whole run.
+        mapping_migrators = []
+
         for organization in self.src.tenant.organizations:
             migrator = OrganizationMigrator(destination_client=self.dst, source_organization=organization)
             destination_organization = migrator.migrate()
 
-            for mapping in organization.account_store_mappings:
-                migrator = OrganizationAccountStoreMappingMigrator(destination_organization=destination_organization, source_account_store_mapping=mapping)
-                migrator.migrate()
+            mapping_migrators.extend(
+                OrganizationAccountStoreMappingMigrator(destination_organization=destination_organization, source_account_store_mapping=mapping)
+                for mapping in organization.account_store_mappings
+            )
 
         for application in self.src.applications:
             if application.name == 'Stormpath':
@@ -80,9 +85,12 @@ class TenantMigrator(BaseMigrator):
             migrator = ApplicationMigrator(destination_client=self.dst, source_application=application)
             destination_application = migrator.migrate()
 
-            for mapping in application.account_store_mappings:
-                migrator = ApplicationAccountStoreMappingMigrator(destination_application=destination_application, source_account_store_mapping=mapping)
-                migrator.migrate()
+            mapping_migrators.extend(
+                ApplicationAccountStoreMappingMigrator(destination_application=destination_application, source_account_store_mapping=mapping)
+                for mapping in application.account_store_mappings
+            )
+
+        migrate_account_store_mappings(mapping_migrators)
 
         migrator = SubstitutionMigrator(source_client=self.src, destination_client=self.dst)
         migrator.migrate()
@@ -52,7 +52,7 @@ setup(
     ],
     keywords = 'stormpath authentication migration development',
     packages = find_packages(exclude=['tests*']),
-    install_requires = ['docopt', 'stormpath'],
+    install_requires = ['docopt', 'requests', 'stormpath'],
     extras_require = {
         'test': ['coverage', 'pytest', 'pytest-cov', 'python-coveralls'],
     },
@@ -6,7 +6,9 @@ from unittest import TestCase
 from uuid import uuid4
 
 from stormpath.client import Client
+from stormpath.error import Error as StormpathError
 
+from migrate.migrators import account_store_mapping
 from migrate.migrators import ApplicationMigrator, ApplicationAccountStoreMappingMigrator, DirectoryMigrator, GroupMigrator, OrganizationAccountStoreMappingMigrator, OrganizationMigrator
 
 
@@ -17,6 +19,399 @@ DST_CLIENT_ID = environ['DST_CLIENT_ID']
 DST_CLIENT_SECRET = environ['DST_CLIENT_SECRET']
 
 
+# Offline stand-ins for the Stormpath resources the migrators use.  The class
+# names matter, since the migrators use them to pick Tenant collections.
+class Directory(object):
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.href = 'directories/' + name
+        self.fail = fail
+        self.refreshes = 0
+
+    def refresh(self):
+        self.refreshes += 1
+        if self.fail:
+            raise StormpathError({'status': 404, 'message': 'Not found'})
+
+
+class Mapping(object):
+    def __init__(self, account_store, list_index=0, **parent):
+        self.account_store = account_store
+        self.list_index = list_index
+        self.is_default_account_store = False
+        self.is_default_group_store = False
+        self.__dict__.update(parent)
+
+
+class Collection(list):
+    def __init__(self, items=()):
+        super(Collection, self).__init__(items)
+        self.searches = []
+
+    def search(self, query):
+        # Like the API, name searches are case-insensitive.
+        self.searches.append(query['name'])
+        return [item for item in list.__iter__(self) if item.name.lower() == query['name'].lower()]
+
+
+class BrokenCollection(Collection):
+    def __iter__(self):
+        raise StormpathError({'status': 403, 'message': 'Forbidden'})
+
+
+class Tenant(object):
+    href = 'tenants/1'
+
+    def __init__(self, directories):
+        self.directories = Collection(directories)
+
+    def refresh(self):
+        pass
+
+
+class Mappings(Collection):
+    """An Application's mappings, which also stand in for its Client."""
+    def __init__(self):
+        super(Mappings, self).__init__()
+        self._client = self
+        self.account_store_mappings = self
+        self.conflicts = 0
+        self.error_status = None
+        self.walks = 0
+
+    def __iter__(self):
+        self.walks += 1
+        return super(Mappings, self).__iter__()
+
+    def create(self, data):
+        if self.error_status:
+            raise StormpathError({'status': self.error_status, 'message': 'Failed'})
+
+        mapping = Mapping(data['account_store'], data['list_index'], application=data['application'])
+        self.append(mapping)
+
+        # Simulate a create which succeeded, but whose response was lost.
+        if self.conflicts:
+            self.conflicts -= 1
+            raise StormpathError({'status': 409, 'message': 'Conflict'})
+
+        return mapping
+
+
+class Application(object):
+    def __init__(self, name, tenant):
+        self.name = name
+        self.href = 'applications/' + name
+        self.tenant = tenant
+        self.account_store_mappings = Mappings()
+
+    def refresh(self):
+        pass
+
+
+class RetryTest(TestCase):
+    def setUp(self):
+        self.delays = []
+        self.sleep = account_store_mapping.sleep
+        self.uniform = account_store_mapping.uniform
+        account_store_mapping.sleep = self.delays.append
+        account_store_mapping.uniform = lambda a, b: 0
+
+    def tearDown(self):
+        account_store_mapping.sleep = self.sleep
+        account_store_mapping.uniform = self.uniform
+
+    def failing(self, statuses, result='ok'):
+        statuses = list(statuses)
+
+        def fn():
+            if statuses:
+                raise StormpathError({'status': statuses.pop(0), 'message': 'boom'})
+            return result
+
+        return fn
+
+    def test_returns_result(self):
+        self.assertEqual(account_store_mapping._retry(self.failing([]), 'test'), 'ok')
+        self.assertEqual(self.delays, [])
+
+    def test_retries_server_errors_with_backoff(self):
+        fn = self.failing([500] * 6)
+        self.assertEqual(account_store_mapping._retry(fn, 'test', max_retries=6, base=1.0, cap=10.0), 'ok')
+        self.assertEqual(self.delays, [1.0, 2.0, 4.0, 8.0, 10.0, 10.0])
+
+    def test_adds_jitter(self):
+        account_store_mapping.uniform = lambda a, b: b
+        account_store_mapping._retry(self.failing([500, 500]), 'test', base=2.0)
+        self.assertEqual(self.delays, [3.0, 6.0])
+
+    def test_retries_rate_limits(self):
+        self.assertEqual(account_store_mapping._retry(self.failing([429]), 'test'), 'ok')
+        self.assertEqual(self.delays, [1.0])
+
+    def test_raises_client_errors_immediately(self):
+        with self.assertRaises(StormpathError):
+            account_store_mapping._retry(self.failing([404]), 'test')
+
+        self.assertEqual(self.delays, [])
+
+    def test_raises_after_max_retries(self):
+        with self.assertRaises(StormpathError):
+            account_store_mapping._retry(self.failing([503] * 4), 'test', max_retries=3)
+
+        self.assertEqual(len(self.delays), 3)
+
+
+class MemoizeTest(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.time = account_store_mapping.time
+        account_store_mapping.time = lambda: self.now
+        account_store_mapping._cache.clear()
+        self.calls = []
+
+    def tearDown(self):
+        account_store_mapping.time = self.time
+        account_store_mapping._cache.clear()
+
+    def fetch(self, value='value'):
+        def fn():
+            self.calls.append(value)
+            return value
+
+        return fn
+
+    def test_caches_results(self):
+        self.assertEqual(account_store_mapping._memoize(('key',), self.fetch()), 'value')
+        self.assertEqual(account_store_mapping._memoize(('key',), self.fetch()), 'value')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_expires_results(self):
+        account_store_mapping._memoize(('key',), self.fetch())
+
+        self.now += account_store_mapping.CACHE_TTL - 1
+        account_store_mapping._memoize(('key',), self.fetch())
+        self.assertEqual(len(self.calls), 1)
+
+        self.now += 1
+        account_store_mapping._memoize(('key',), self.fetch())
+        self.assertEqual(len(self.calls), 2)
+
+    def test_does_not_cache_none(self):
+        self.assertIsNone(account_store_mapping._memoize(('key',), self.fetch(None)))
+        self.assertEqual(account_store_mapping._memoize(('key',), self.fetch()), 'value')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_clears_when_full(self):
+        for i in range(account_store_mapping.CACHE_SIZE):
+            account_store_mapping._memoize(('key', i), self.fetch())
+
+        self.assertEqual(len(account_store_mapping._cache), account_store_mapping.CACHE_SIZE)
+
+        account_store_mapping._memoize(('extra',), self.fetch())
+        self.assertEqual(len(account_store_mapping._cache), 1)
+
+    def test_get_tenant_is_shared_per_tenant(self):
+        class Tenant(object):
+            href = 'tenant'
+            refreshes = 0
+
+            def refresh(self):
+                self.refreshes += 1
+
+        class Parent(object):
+            def __init__(self, href, tenant):
+                self.href = href
+                self.tenant = tenant
+
+        tenant = Tenant()
+        self.assertIs(account_store_mapping._get_tenant(Parent('application', tenant)), tenant)
+        self.assertIs(account_store_mapping._get_tenant(Parent('organization', tenant)), tenant)
+        self.assertEqual(tenant.refreshes, 1)
+
+
+class PrefetchTest(TestCase):
+    class Directory(object):
+        def __init__(self, name, href):
+            self.name = name
+            self.href = href
+
+    class Collection(list):
+        def __init__(self, items):
+            super(PrefetchTest.Collection, self).__init__(items)
+            self.searches = []
+
+        def search(self, query):
+            self.searches.append(query['name'])
+            return [item for item in self if item.name == query['name']]
+
+    class Tenant(object):
+        href = 'tenant'
+
+        def __init__(self, directories):
+            self.directories = PrefetchTest.Collection(directories)
+
+    def setUp(self):
+        account_store_mapping._cache.clear()
+        self.first = self.Directory('a', 'first')
+        self.tenant = self.Tenant([self.first, self.Directory('a', 'second'), self.Directory('b', 'other')])
+
+    def tearDown(self):
+        account_store_mapping._cache.clear()
+
+    def test_prefetch(self):
+        index = account_store_mapping._prefetch_destination_stores(self.tenant, [('directories', 'a'), ('directories', 'missing')])
+
+        self.assertEqual(index, {('directories', 'a'): self.first})
+        self.assertIs(account_store_mapping._find_destination_store(self.tenant, 'directories', 'a'), self.first)
+        self.assertEqual(self.tenant.directories.searches, [])
+
+    def test_falls_back_on_index_miss(self):
+        migrator = ApplicationAccountStoreMappingMigrator(destination_application=None, source_account_store_mapping=None)
+        migrator.destination_tenant = self.tenant
+        migrator.source_account_store = self.Directory('b', 'source')
+        migrator.destination_store_index = {}
+
+        self.assertEqual(migrator.get_destination_account_store().href, 'other')
+        self.assertEqual(self.tenant.directories.searches, ['b'])
+
+
+class AccountStoreMappingBatchTest(TestCase):
+    def test_migrates_in_list_index_order(self):
+        order = []
+
+        class Mapping(object):
+            def __init__(self, list_index):
+                self.list_index = list_index
+
+        class Migrator(object):
+            def __init__(self, list_index):
+                self.source_account_store_mapping = Mapping(list_index)
+                self._existing_mappings_by_store = None
+
+            def migrate(self):
+                order.append(self.source_account_store_mapping.list_index)
+                return self.source_account_store_mapping.list_index
+
+        batch = account_store_mapping._AccountStoreMappingBatch([Migrator(i) for i in [3, 0, 2, 1]])
+        self.assertEqual(batch.migrate(), [0, 1, 2, 3])
+        self.assertEqual(order, [0, 1, 2, 3])
+
+    def test_keeps_going_after_errors(self):
+        application = Application('app', Tenant([]))
+
+        class Migrator(object):
+            _PARENT_ATTR = 'destination_application'
+
+            def __init__(self, list_index):
+                self.destination_application = application
+                self.source_account_store_mapping = Mapping(None, list_index)
+                self.source_account_store_mapping.href = 'mappings/{}'.format(list_index)
+                self._existing_mappings_by_store = None
+
+            def migrate(self):
+                if self.source_account_store_mapping.list_index == 1:
+                    raise ValueError('Failed!')
+
+                return self.source_account_store_mapping.list_index
+
+        batch = account_store_mapping._AccountStoreMappingBatch([Migrator(i) for i in range(3)])
+        self.assertEqual(batch.migrate(), [0, None, 2])
+        self.assertIn('applications/app', repr(batch))
+
+    def test_shares_existing_mappings(self):
+        account_store_mapping._cache.clear()
+        tenant = Tenant([Directory('a'), Directory('b'), Directory('c')])
+        application = Application('app', tenant)
+
+        batch = account_store_mapping._AccountStoreMappingBatch([
+            ApplicationAccountStoreMappingMigrator(destination_application=application, source_account_store_mapping=Mapping(Directory(name), i))
+            for i, name in enumerate('abc')
+        ])
+        batch.migrate()
+
+        self.assertEqual(application.account_store_mappings.walks, 1)
+        self.assertEqual([m.account_store.name for m in application.account_store_mappings], ['a', 'b', 'c'])
+        account_store_mapping._cache.clear()
+
+
+class MigrateAccountStoreMappingsTest(TestCase):
+    def setUp(self):
+        account_store_mapping._cache.clear()
+        self.tenant = Tenant([Directory('a'), Directory('b'), Directory('c')])
+        self.app1 = Application('app1', self.tenant)
+        self.app2 = Application('app2', self.tenant)
+
+    def tearDown(self):
+        account_store_mapping._cache.clear()
+
+    def migrator(self, application, source_account_store, list_index=0):
+        return ApplicationAccountStoreMappingMigrator(destination_application=application, source_account_store_mapping=Mapping(source_account_store, list_index))
+
+    def test_migrates_by_parent_in_input_order(self):
+        b = Directory('b')
+        migrators = [
+            self.migrator(self.app1, b, 1),
+            self.migrator(self.app2, Directory('c')),
+            self.migrator(self.app1, Directory('a'), 0),
+        ]
+        results = account_store_mapping.migrate_account_store_mappings(migrators)
+
+        self.assertIs(results[0], self.app1.account_store_mappings[1])
+        self.assertIs(results[1], self.app2.account_store_mappings[0])
+        self.assertIs(results[2], self.app1.account_store_mappings[0])
+        self.assertEqual([m.account_store.name for m in self.app1.account_store_mappings], ['a', 'b'])
+        self.assertEqual(b.refreshes, 1)
+        self.assertEqual(self.tenant.directories.searches, [])
+
+    def test_skips_unreadable_source_account_stores(self):
+        migrators = [self.migrator(self.app1, Directory('a', fail=True)), self.migrator(self.app1, Directory('b'), 1)]
+        results = account_store_mapping.migrate_account_store_mappings(migrators)
+
+        self.assertIsNone(results[0])
+        self.assertIs(results[1].account_store, self.tenant.directories[1])
+        self.assertEqual(len(self.app1.account_store_mappings), 1)
+
+    def test_searches_when_prefetch_fails(self):
+        self.tenant.directories = BrokenCollection(self.tenant.directories)
+        migrator = self.migrator(self.app1, Directory('a'))
+        results = account_store_mapping.migrate_account_store_mappings([migrator])
+
+        self.assertIsNone(migrator.destination_store_index)
+        self.assertIs(results[0].account_store, self.tenant.directories[0])
+        self.assertEqual(self.tenant.directories.searches, ['a'])
+
+    def test_searches_on_prefetch_miss(self):
+        results = account_store_mapping.migrate_account_store_mappings([self.migrator(self.app1, Directory('A'))])
+
+        self.assertIs(results[0].account_store, self.tenant.directories[0])
+        self.assertEqual(self.tenant.directories.searches, ['A'])
+
+    def test_skips_when_copy_fails(self):
+        self.app1.account_store_mappings.error_status = 400
+        results = account_store_mapping.migrate_account_store_mappings([self.migrator(self.app1, Directory('a'))])
+
+        self.assertEqual(results, [None])
+        self.assertEqual(len(self.app1.account_store_mappings), 0)
+
+    def test_empty(self):
+        self.assertEqual(account_store_mapping.migrate_account_store_mappings([]), [])
+
+
+class CopyMappingTest(TestCase):
+    def test_recovers_from_conflict(self):
+        tenant = Tenant([Directory('a')])
+        application = Application('app', tenant)
+        application.account_store_mappings.conflicts = 1
+
+        migrator = ApplicationAccountStoreMappingMigrator(destination_application=application, source_account_store_mapping=Mapping(Directory('a')), existing_mappings={})
+        migrator.destination_account_store = tenant.directories[0]
+
+        self.assertIs(migrator.copy_mapping(), application.account_store_mappings[0])
+        self.assertEqual(len(application.account_store_mappings), 1)
+        self.assertIs(migrator.get_existing_mappings()['directories/a'], application.account_store_mappings[0])
+
+
 class ApplicationAccountStoreMappingMigratorTest(TestCase):
     def setUp(self):
         self.src = Client(id=SRC_CLIENT_ID, secret=SRC_CLIENT_SECRET)
@@ -95,6 +490,29 @@ class ApplicationAccountStoreMappingMigratorTest(TestCase):
         self.assertEqual(account_store.name, self.dst_group.name)
         self.assertEqual(account_store.description, self.dst_group.description)
 
+    def test_prefetch_destination_stores(self):
+        index = ApplicationAccountStoreMappingMigrator.prefetch_destination_stores(self.dst_app.tenant, [
+            ('directories', self.src_dir.name),
+            ('organizations', self.src_org.name),
+            ('groups', self.src_group.name),
+            ('directories', uuid4().hex),
+        ])
+
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index[('directories', self.src_dir.name)].href, self.dst_dir.href)
+        self.assertEqual(index[('organizations', self.src_org.name)].href, self.dst_org.href)
+        self.assertEqual(index[('groups', self.src_group.name)].href, self.dst_group.href)
+
+    def test_get_existing_mappings(self):
+        migrator = ApplicationAccountStoreMappingMigrator(destination_application=self.src_app, source_account_store_mapping=self.src_mapping_1)
+        existing_mappings = migrator.get_existing_mappings()
+
+        self.assertEqual(len(existing_mappings), 3)
+        self.assertEqual(existing_mappings[self.src_dir.href].href, self.src_mapping_1.href)
+        self.assertEqual(existing_mappings[self.src_org.href].href, self.src_mapping_2.href)
+        self.assertEqual(existing_mappings[self.src_group.href].href, self.src_mapping_3.href)
+        self.assertIs(migrator.get_existing_mappings(), existing_mappings)
+
     def test_copy_mapping(self):
         migrator = ApplicationAccountStoreMappingMigrator(destination_application=self.dst_app, source_account_store_mapping=self.src_mapping_1)
         migrator.destination_tenant = migrator.destination_application.tenant
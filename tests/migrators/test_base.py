@@ -7,7 +7,7 @@ from uuid import uuid4
 
 from stormpath.client import Client
 
-from migrate.migrators import BaseMigrator, DirectoryMigrator
+from migrate.migrators import BaseMigrator, DirectoryMigrator, migrate_all
 
 
 # Necessary environment variables.
@@ -35,3 +35,22 @@ class BaseMigratorTest(TestCase):
     def test_repr(self):
         migrator = BaseMigrator(self.src, self.dst, passwords='hi.txt')
         self.assertEqual('BaseMigrator()', migrator.__repr__())
+
+
+class MigrateAllTest(TestCase):
+    class Migrator(object):
+        def __init__(self, value):
+            self.value = value
+
+        def migrate(self):
+            if self.value is None:
+                raise ValueError('Failed!')
+
+            return self.value
+
+    def test_returns_results_in_order(self):
+        migrators = [self.Migrator(value) for value in [1, 2, None, 4, 5, 6]]
+        self.assertEqual(migrate_all(migrators, max_workers=3), [1, 2, None, 4, 5, 6])
+
+    def test_empty(self):
+        self.assertEqual(migrate_all([]), [])